@@ -1,14 +1,31 @@
 import os
 import json
+import hmac
+import time
+import click
 import cloudinary
+import cloudinary.api
 import cloudinary.uploader
+import cloudinary.utils
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash
+from urllib.parse import urlparse
+from flask import Flask, render_template, request, redirect, url_for, flash, g, jsonify, make_response, abort, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import load_only, raiseload
+from sqlalchemy.pool import NullPool
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 from flask_babel import Babel, format_date
+from flask_caching import Cache
+from jinja2 import FileSystemBytecodeCache
+from whitenoise import WhiteNoise
 from dotenv import load_dotenv
+from redis import Redis, RedisError
+from rq import Queue
 
 load_dotenv()
 
@@ -24,6 +41,24 @@ if uri and uri.startswith("postgres://"):
 app.config['SQLALCHEMY_DATABASE_URI'] = uri or 'sqlite:///database.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Пул соединений: на Vercel каждый вызов живёт недолго, поэтому соединения не держим,
+# а на постоянном сервере проверяем и периодически обновляем их, чтобы не ловить обрывы
+if os.environ.get('VERCEL'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'poolclass': NullPool}
+elif uri:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_pre_ping': True,
+        'pool_recycle': 300,
+        'pool_use_lifo': True,
+    }
+    # Недоступная БД не должна вешать воркер: ждём подключения не дольше 5 секунд.
+    # connect_timeout понимает только libpq, для других драйверов его не передаём
+    if make_url(uri).get_backend_name() == 'postgresql':
+        app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {'connect_timeout': 5}
+app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
+
 app.config['BABEL_DEFAULT_LOCALE'] = 'ru'
 
 # Настройка Cloudinary
@@ -33,14 +68,61 @@ cloudinary.config(
     api_secret = os.environ.get('CLOUDINARY_API_SECRET')
 )
 
+# Redis необязателен: без REDIS_URL кэши просто отключены
+REDIS_URL = os.environ.get('REDIS_URL')
+
+# Короткие таймауты: зависший Redis не должен вешать запросы, при ошибке идём в БД
+REDIS_TIMEOUTS = {'socket_connect_timeout': 1, 'socket_timeout': 1}
+
+# Фоновые задачи через RQ; нужен запущенный `rq worker`, поэтому включаются явно
+USE_TASK_QUEUE = bool(REDIS_URL and os.environ.get('USE_TASK_QUEUE'))
+
+# Сколько секунд пользователь живёт в кэше Redis
+USER_CACHE_TIMEOUT = 300
+
+# Публичные страницы кэшируются целиком; при изменении постов кэш сбрасывается
+PAGE_CACHE_TIMEOUT = 60
+if REDIS_URL:
+    app.config['CACHE_TYPE'] = 'RedisCache'
+    app.config['CACHE_REDIS_URL'] = REDIS_URL
+    app.config['CACHE_OPTIONS'] = dict(REDIS_TIMEOUTS)
+    # С префиксом cache.clear() удаляет только страницы, а не весь Redis (там же лежат пользователи)
+    app.config['CACHE_KEY_PREFIX'] = 'page:'
+else:
+    app.config['CACHE_TYPE'] = 'SimpleCache'
+
+# Порог запросов к БД на один HTTP-запрос, после которого в debug пишем предупреждение
+QUERY_WARN_THRESHOLD = 5
+
+POSTS_PER_PAGE = 20
+
 ADMIN_USERNAME = os.environ.get('ADMIN_USERNAME', 'admin')
 ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'pivo3228')
 
+# Пароли хэшируем argon2id; старые pbkdf2-хэши перехэшируются при входе
+password_hasher = PasswordHasher(time_cost=3, memory_cost=65536, parallelism=4)
+
+# Хэш-заглушка: проверяем пароль даже для несуществующего логина,
+# чтобы время ответа не выдавало, есть ли такой пользователь
+DUMMY_HASH = password_hasher.hash('x')
+
 # --- Инициализация ---
 db = SQLAlchemy(app)
 babel = Babel(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
+redis_client = Redis.from_url(REDIS_URL, **REDIS_TIMEOUTS) if REDIS_URL else None
+cache = Cache(app)
+task_queue = Queue(connection=redis_client) if USE_TASK_QUEUE else None
+
+# Скомпилированные шаблоны кладём на диск; каталог по умолчанию у Jinja свой для
+# каждого пользователя (права 0700, проверка владельца), поэтому свой путь не задаём
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+# Статику отдаёт WhiteNoise напрямую из WSGI, не доходя до обработчика Flask;
+# имена файлов без хэшей, поэтому кэшируем на 30 дней, а не навсегда
+app.wsgi_app = WhiteNoise(app.wsgi_app, root=os.path.join(app.root_path, 'static'), prefix='static/',
+                          autorefresh=False, max_age=30 * 24 * 60 * 60)
 
 # --- Модели ---
 class User(UserMixin, db.Model):
@@ -49,62 +131,250 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(150), unique=True, nullable=False)
     password = db.Column(db.String(150), nullable=False)
 
+# Логин без учёта регистра: поиск идёт по индексу на lower(username).
+# Индекс уникальный, то есть имена, различающиеся только регистром, больше не допускаются
+db.Index('ix_users_username_lower', func.lower(User.username), unique=True)
+
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     content = db.Column(db.Text, nullable=False)
-    date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
     image_url = db.Column(db.String(500), nullable=True)
     public_id = db.Column(db.String(255), nullable=True)
+    # Анонс для ленты: обрезается на стороне БД, полный content в список не грузим
+    excerpt = db.column_property(db.func.substr(content, 1, 300), deferred=True)
+
+def posts_page(*columns):
+    # Отдаём одну страницу ленты вместо всех постов разом
+    page = request.args.get('page', 1, type=int)
+    return db.paginate(posts_listing(*columns), page=page, per_page=POSTS_PER_PAGE, error_out=False)
+
+def posts_listing(*columns):
+    # Для списков грузим только нужные колонки, сортировка идёт по индексу date_posted
+    stmt = select(Post).options(
+        load_only(Post.id, Post.title, Post.date_posted, Post.image_url, *columns)
+    )
+    if app.debug:
+        # В разработке любая ленивая подгрузка связей в списке сразу падает, а не плодит N+1
+        stmt = stmt.options(raiseload('*'))
+    return stmt.order_by(Post.date_posted.desc())
+
+# --- Счётчик запросов к БД (только debug) ---
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_queries(conn, cursor, statement, parameters, context, executemany):
+    if app.debug and has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+@app.after_request
+def warn_query_count(response):
+    count = g.get('query_count', 0)
+    if count > QUERY_WARN_THRESHOLD:
+        app.logger.warning('%s %s: %d запросов к БД', request.method, request.path, count)
+    return response
 
 @login_manager.user_loader
 def load_user(user_id):
+    # Сначала смотрим в Redis, чтобы не ходить в БД на каждый авторизованный запрос
+    cached = get_cached_user(user_id)
+    if cached:
+        return cached
     # Добавлена проверка, чтобы не падать при ложных сессиях
-    return db.session.get(User, int(user_id))
+    user = db.session.get(User, int(user_id))
+    if user:
+        cache_user(user)
+    return user
+
+def user_cache_key(user_id):
+    return f'user:{user_id}'
+
+def get_cached_user(user_id):
+    if redis_client is None:
+        return None
+    try:
+        data = redis_client.get(user_cache_key(user_id))
+    except RedisError:
+        return None
+    if data is None:
+        return None
+    # Хэш пароля в кэш не кладём: для сессии он не нужен
+    return User(**json.loads(data))
+
+def cache_user(user):
+    if redis_client is None:
+        return
+    try:
+        redis_client.setex(user_cache_key(user.id), USER_CACHE_TIMEOUT,
+                           json.dumps({'id': user.id, 'username': user.username}))
+    except RedisError:
+        pass
+
+def forget_user(user_id):
+    if redis_client is None:
+        return
+    try:
+        redis_client.delete(user_cache_key(user_id))
+    except RedisError:
+        pass
+
+def verify_password(password_hash, password):
+    if password_hash.startswith('pbkdf2:'):
+        return check_password_hash(password_hash, password)
+    try:
+        return password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def needs_rehash(password_hash):
+    return password_hash.startswith('pbkdf2:') or password_hasher.check_needs_rehash(password_hash)
+
+def destroy_images(public_ids):
+    # Одну картинку удаляем через Upload API: у Admin API (delete_resources) почасовой лимит,
+    # поэтому его оставляем для пачек, где он экономит запросы
+    if len(public_ids) == 1:
+        cloudinary.uploader.destroy(public_ids[0])
+    else:
+        cloudinary.api.delete_resources(public_ids)
+
+def schedule_image_cleanup(public_ids):
+    if task_queue is not None:
+        try:
+            task_queue.enqueue(destroy_images, public_ids)
+            return
+        except RedisError:
+            app.logger.warning('Не удалось поставить удаление картинок в очередь: %s', public_ids)
+    try:
+        destroy_images(public_ids)
+    except Exception:
+        app.logger.exception('Не удалось удалить картинки из Cloudinary: %s', public_ids)
+
+def is_cloudinary_url(url):
+    # Принимаем только https-ссылки на ресурсы нашего облака
+    parts = urlparse(url)
+    return (parts.scheme == 'https' and parts.hostname == 'res.cloudinary.com'
+            and parts.path.startswith(f'/{cloudinary.config().cloud_name}/'))
+
+def url_matches_public_id(url, public_id):
+    # Ссылка вида .../upload/v123/<public_id>.<ext>: путь без расширения должен заканчиваться на public_id
+    if not public_id:
+        return False
+    path = os.path.splitext(urlparse(url).path)[0]
+    return path.endswith(f'/{public_id}')
 
 # --- Контекст и фильтры ---
+# Год для подвала пересчитываем раз в сутки, а не на каждый рендер: [номер дня, год]
+_YEAR_CACHE = [0, 0]
+
 @app.context_processor
 def inject_year():
-    return {'year': datetime.utcnow().year}
+    day = int(time.time()) // 86400
+    if day != _YEAR_CACHE[0]:
+        _YEAR_CACHE[:] = [day, datetime.utcnow().year]
+    return {'year': _YEAR_CACHE[1]}
 
 @app.template_filter('datetimeformat')
 def format_datetime_filter(value, format='d MMMM yyyy'):
-    if value is None: return ""
+    if not value: return ""
     return format_date(value, format)
 
+@app.template_filter('cld')
+def cloudinary_transform_filter(url, width=800):
+    # Cloudinary сам подберёт формат (AVIF/WebP) и качество под клиента;
+    # c_limit только уменьшает картинку, маленькие не растягиваются до width
+    if not url or '/upload/' not in url:
+        return url
+    return url.replace('/upload/', f'/upload/f_auto,q_auto,c_limit,w_{width}/', 1)
+
+def page_cache_key(*args, **kwargs):
+    # Гости и админ видят разную шапку, поэтому кэшируем их версии отдельно
+    suffix = '|auth' if current_user.is_authenticated else ''
+    return f'view/{request.full_path}{suffix}'
+
+def revalidated_response(html, last_modified=None):
+    # Браузер каждый раз переспрашивает сервер, но при совпадении ETag получает пустой 304
+    response = make_response(html)
+    if last_modified:
+        response.last_modified = last_modified
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response
+
+@app.after_request
+def conditional_response(response):
+    # 304 собираем уже после кэша страниц, чтобы в кэш не попал ответ без тела
+    if response.headers.get('ETag'):
+        response.make_conditional(request)
+    return response
+
 # --- Маршруты ---
 
 @app.route('/')
+@cache.cached(timeout=PAGE_CACHE_TIMEOUT, make_cache_key=page_cache_key)
 def index():
     return render_template('index.html')
 
-@app.route('/team')
-def team():
+# Состав команды меняется редко: держим распарсенный JSON в памяти
+# и перечитываем файл только при изменении его mtime
+_TEAM_CACHE = {'mtime': 0, 'data': {}}
+
+def load_team_data():
+    json_path = os.path.join(app.root_path, 'instance', 'members.json')
     try:
-        json_path = os.path.join(app.root_path, 'instance', 'members.json')
-        with open(json_path, 'r', encoding='utf-8') as f:
-            team_data = json.load(f)
+        mtime = os.stat(json_path).st_mtime
+        if mtime != _TEAM_CACHE['mtime']:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                _TEAM_CACHE['data'] = json.load(f)
+            _TEAM_CACHE['mtime'] = mtime
     except:
-        team_data = {}
-    return render_template('team.html', team_data=team_data, title="Наша команда")
+        _TEAM_CACHE['mtime'] = 0
+        _TEAM_CACHE['data'] = {}
+    return _TEAM_CACHE['data']
+
+@app.route('/team')
+@cache.cached(timeout=PAGE_CACHE_TIMEOUT, make_cache_key=page_cache_key)
+def team():
+    return render_template('team.html', team_data=load_team_data(), title="Наша команда")
 
 @app.route('/blog')
+@cache.cached(timeout=PAGE_CACHE_TIMEOUT, make_cache_key=page_cache_key)
 def blog():
-    posts = Post.query.order_by(Post.date_posted.desc()).all()
-    return render_template('blog.html', posts=posts, title="Блог")
+    pagination = posts_page(Post.excerpt)
+    html = render_template('blog.html', posts=pagination.items, pagination=pagination, title="Блог")
+    # Без Last-Modified: дата последнего поста не меняется при удалении, и клиент
+    # с одним If-Modified-Since получал бы 304 на устаревшую ленту. Хватает ETag
+    return revalidated_response(html)
 
 @app.route('/post/<int:post_id>')
+@cache.cached(timeout=PAGE_CACHE_TIMEOUT, make_cache_key=page_cache_key)
 def post(post_id):
-    post_item = Post.query.get_or_404(post_id)
-    return render_template('post.html', post=post_item, title=post_item.title)
+    post_item = db.get_or_404(Post, post_id)
+    html = render_template('post.html', post=post_item, title=post_item.title)
+    return revalidated_response(html, post_item.date_posted)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('admin'))
     if request.method == 'POST':
-        user = User.query.filter_by(username=request.form.get('username')).first()
-        if user and check_password_hash(user.password, request.form.get('password')):
+        password = request.form.get('password') or ''
+        username = request.form.get('username') or ''
+        # lower() с обеих сторон считает БД: SQLite понижает только ASCII, и Python-овский
+        # .lower() для кириллицы дал бы несовпадение. first(), а не scalar_one_or_none(),
+        # пока на старой базе нет уникального индекса и возможны дубли по регистру;
+        # тогда берём самого раннего пользователя, а не случайного
+        user = db.session.execute(
+            select(User).where(func.lower(User.username) == func.lower(username)).order_by(User.id)
+        ).scalars().first()
+        if user is None:
+            verify_password(DUMMY_HASH, password)
+            authenticated = False
+        else:
+            authenticated = verify_password(user.password, password)
+        if authenticated:
+            if needs_rehash(user.password):
+                user.password = password_hasher.hash(password)
+                db.session.commit()
+            forget_user(user.id)
             login_user(user)
             return redirect(url_for('admin'))
         flash('Ошибка входа. Проверьте данные.', 'danger')
@@ -120,57 +390,98 @@ def logout():
 @login_required
 def admin():
     if request.method == 'POST':
+        # Картинка уже загружена браузером напрямую в Cloudinary, сюда приходят только ссылки
         title = request.form.get('title')
         content = request.form.get('content')
-        image = request.files.get('image')
+        img_url = request.form.get('image_url') or None
+        p_id = request.form.get('public_id') or None
 
-        img_url = None
-        p_id = None
-
-        if image and image.filename != '':
-            try:
-                upload_result = cloudinary.uploader.upload(image)
-                img_url = upload_result.get('secure_url')
-                p_id = upload_result.get('public_id')
-            except Exception as e:
-                flash(f'Ошибка Cloudinary: {e}', 'danger')
+        if img_url and not is_cloudinary_url(img_url):
+            flash('Некорректная ссылка на изображение', 'danger')
+            img_url = None
+        # public_id потом уйдёт в destroy, поэтому берём его только вместе со ссылкой на этот же файл
+        if not img_url or not url_matches_public_id(img_url, p_id):
+            p_id = None
 
         new_post = Post(title=title, content=content, image_url=img_url, public_id=p_id)
         db.session.add(new_post)
         db.session.commit()
+        cache.clear()
         flash('Пост опубликован!', 'success')
         return redirect(url_for('admin'))
 
-    posts = Post.query.order_by(Post.date_posted.desc()).all()
-    return render_template('admin.html', title="Админ-панель", posts=posts)
+    pagination = posts_page()
+    return render_template('admin.html', title="Админ-панель", posts=pagination.items, pagination=pagination,
+                           cloud_name=cloudinary.config().cloud_name, api_key=cloudinary.config().api_key)
+
+@app.route('/sign_upload', methods=['POST'])
+@login_required
+def sign_upload():
+    # Подписываем параметры, которые прислал виджет загрузки Cloudinary
+    params_to_sign = request.get_json(silent=True) or {}
+    signature = cloudinary.utils.api_sign_request(params_to_sign, cloudinary.config().api_secret)
+    return jsonify(signature=signature)
 
 @app.route('/delete_post/<int:post_id>', methods=['POST'])
 @login_required
 def delete_post(post_id):
-    post_item = Post.query.get_or_404(post_id)
-    if post_item.public_id:
-        try:
-            cloudinary.uploader.destroy(post_item.public_id)
-        except:
-            pass
+    post_item = db.get_or_404(Post, post_id)
+    public_id = post_item.public_id
     db.session.delete(post_item)
     db.session.commit()
+    cache.clear()
+    # Картинку удаляем уже после коммита, чтобы сетевой вызов не держал транзакцию
+    if public_id:
+        schedule_image_cleanup([public_id])
     flash('Пост удален', 'success')
     return redirect(url_for('admin'))
 
 # --- ИНИЦИАЛИЗАЦИЯ (Запустить один раз!) ---
+# Токен для /init-db; без него маршрут недоступен и остаётся только `flask init-db`
+INIT_TOKEN = os.environ.get('INIT_TOKEN')
+_INIT_DONE = [False]
+
+def create_database():
+    db.create_all()
+    admin_exists = db.session.execute(
+        select(User).where(func.lower(User.username) == func.lower(ADMIN_USERNAME)).order_by(User.id)
+    ).scalars().first()
+    if not admin_exists:
+        hashed_password = password_hasher.hash(ADMIN_PASSWORD)
+        admin_user = User(username=ADMIN_USERNAME, password=hashed_password)
+        db.session.add(admin_user)
+        db.session.commit()
+    elif admin_exists.password.startswith('pbkdf2:'):
+        # Старый pbkdf2 проверяется дольше argon2-заглушки, и по времени ответа было бы видно,
+        # что такой логин есть; перехэшируем пароль админа сразу, не дожидаясь его входа
+        admin_exists.password = password_hasher.hash(ADMIN_PASSWORD)
+        db.session.commit()
+
+@app.cli.command('init-db')
+def init_db_command():
+    create_database()
+    click.echo("База данных успешно создана и админ добавлен!")
+
 @app.route('/init-db')
 def init_db():
+    # Сканеры получают 404 без единого запроса к БД
+    if not INIT_TOKEN or not hmac.compare_digest(request.args.get('token', '').encode(), INIT_TOKEN.encode()):
+        abort(404)
+    if _INIT_DONE[0]:
+        return "База данных уже инициализирована"
     try:
-        db.create_all()
-        if not User.query.filter_by(username=ADMIN_USERNAME).first():
-            hashed_password = generate_password_hash(ADMIN_PASSWORD, method='pbkdf2:sha256')
-            admin_user = User(username=ADMIN_USERNAME, password=hashed_password)
-            db.session.add(admin_user)
-            db.session.commit()
+        create_database()
+        _INIT_DONE[0] = True
         return "База данных успешно создана и админ добавлен!"
     except Exception as e:
         return f"Ошибка при инициализации: {e}"
 
+def precompile_templates():
+    # Компилируем все шаблоны при старте, чтобы первый заход на страницу не ждал компиляции
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+precompile_templates()
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file